@@ -1,19 +1,80 @@
+import collections
+import functools
 import os
 import logging
-import pathlib
+import shutil
 import sys
 import json
 import subprocess
+import tempfile
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, wait
 
-from aced_submission.meta_flat_load import DEFAULT_ELASTIC
+import requests
 from gen3.auth import Gen3Auth
 
-from aced_submission.fhir_store import fhir_get
-from gen3_util.config import Config
-from gen3_util.meta.uploader import cp
-
 logging.getLogger().addHandler(logging.StreamHandler(sys.stdout))
 
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+# (connect, read) seconds for fence and bucket requests, the read timeout applies between received chunks
+HTTP_TIMEOUT = (10, 300)
+MAX_DOWNLOAD_WORKERS = 16
+MAX_EXTRACT_WORKERS = 8
+SCHEMA_URL = 'https://aced-public.s3.us-west-2.amazonaws.com/aced-test.json'
+MAX_LOG_LINES = int(os.environ.get('MAX_LOG_LINES', 10000))
+
+# permissions checked by _can_create / _can_read
+SUBMISSION_RESOURCES = frozenset({
+    '/services/sheepdog/submission/program',
+    '/services/sheepdog/submission/project',
+})
+SHEEPDOG_AUTHZ = {'method': '*', 'service': 'sheepdog'}
+READ_STORAGE_AUTHZ = {'method': 'read-storage', 'service': '*'}
+
+
+class _Logs:
+    """Append-only list of log lines, each encoded to json as it is added.
+
+    At most MAX_LOG_LINES lines are kept so a chatty loader can't grow the output
+    without bound: the first half (permission checks, downloads) and the most recent
+    half, with a marker in between counting the lines that were dropped.
+    """
+
+    def __init__(self, max_lines=MAX_LOG_LINES):
+        self._head = []
+        self._head_size = max_lines - max_lines // 2
+        self._tail = collections.deque(maxlen=max_lines // 2)
+        self._dropped = 0
+
+    def append(self, line):
+        line = json.dumps(line, separators=(',', ':'))
+        if len(self._head) < self._head_size:
+            self._head.append(line)
+            return
+        if len(self._tail) == self._tail.maxlen:
+            self._dropped += 1
+        self._tail.append(line)
+
+    def extend(self, lines):
+        for line in lines:
+            self.append(line)
+
+    def to_json(self) -> str:
+        lines = self._head
+        if self._dropped:
+            lines = lines + [json.dumps(f"... {self._dropped} log lines dropped ...")]
+        return f"[{','.join(lines + list(self._tail))}]"
+
+
+def _dumps(output) -> str:
+    """Serialize output to compact json, splicing in the already encoded logs"""
+    fields = []
+    for key, value in output.items():
+        value = value.to_json() if isinstance(value, _Logs) else json.dumps(value, separators=(',', ':'))
+        fields.append(f"{json.dumps(key)}:{value}")
+    return f"{{{','.join(fields)}}}"
+
 
 def _get_token() -> str:
     """Get ACCESS_TOKEN from environment"""
@@ -21,6 +82,7 @@ def _get_token() -> str:
     return os.environ.get('ACCESS_TOKEN', None)
 
 
+@functools.lru_cache(maxsize=1)
 def _auth(access_token: str) -> Gen3Auth:
     """Authenticate using ACCESS_TOKEN"""
     # print("[out] authorizing...")
@@ -31,13 +93,33 @@ def _auth(access_token: str) -> Gen3Auth:
     return Gen3Auth()
 
 
+@functools.lru_cache(maxsize=1)
 def _user(auth: Gen3Auth) -> dict:
-    """Get user info from arborist"""
-    return auth.curl('/user/user').json()
+    """Get user info from arborist, cached for the lifetime of the process"""
+    response = auth.curl('/user/user')
+    # raise rather than cache a failed (e.g. 401) lookup
+    response.raise_for_status()
+    return response.json()
+
+
+@functools.lru_cache(maxsize=1)
+def _session() -> requests.Session:
+    """Shared http session, so fence and bucket requests reuse pooled (keep-alive) connections"""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=MAX_DOWNLOAD_WORKERS)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+@functools.lru_cache(maxsize=1)
+def _base_env() -> dict:
+    """Snapshot of the environment, shared by every load_all invocation"""
+    return dict(os.environ)
 
 
-def _input_data() -> dict:
-    """Get input data"""
+def _input_data():
+    """Get input data, either a single work item (dict) or a list of them"""
     assert 'INPUT_DATA' in os.environ, "INPUT_DATA not found in environment"
     return json.loads(os.environ['INPUT_DATA'])
 
@@ -46,12 +128,23 @@ def _get_program_project(input_data) -> tuple:
     """Get program and project from input_data"""
     assert 'project_id' in input_data, "project_id not found in INPUT_DATA"
     assert '-' in input_data['project_id'], 'project_id must be in the format <program>-<project>'
-    return input_data['project_id'].split('-')
+    program, project = input_data['project_id'].split('-')
+    # project names a directory under studies/, which is cleared before each import or export
+    assert project and '/' not in project and project not in ('.', '..'), \
+        f"invalid project in project_id {input_data['project_id']}"
+    return program, project
 
 
-def _get_object_id(input_data) -> str:
-    """Get object_id from input_data"""
-    return input_data.get('object_id', None)
+def _get_object_ids(input_data) -> list:
+    """Get object_ids from input_data, accepts `object_id` and/or a list of `object_ids`"""
+    object_ids = input_data.get('object_ids', None) or []
+    if isinstance(object_ids, str):
+        # a single id, not a sequence of one character ids
+        object_ids = [object_ids]
+    if input_data.get('object_id', None):
+        object_ids = [input_data['object_id'], *object_ids]
+    # download each object once, keeping the given order
+    return list(dict.fromkeys(object_ids))
 
 
 def _can_create(output, program, user) -> bool:
@@ -63,37 +156,35 @@ def _can_create(output, program, user) -> bool:
         user: user dict from arborist (aka profile)
     """
 
+    resources = set(user['resources'])
+    authz = user['authz']
     can_create = True
 
-    if f"/programs/{program}" not in user['resources']:
+    if f"/programs/{program}" not in resources:
         output['logs'].append(f"/programs/{program} not found in user resources")
         can_create = False
 
-    required_resources = [
-        '/services/sheepdog/submission/program',
-        '/services/sheepdog/submission/project',
-        f"/programs/{program}/projects"
-    ]
-    for required_resource in required_resources:
-        if required_resource not in user['resources']:
-            output['logs'].append(f"{required_resource} not found in user resources")
-            can_create = False
-        else:
-            output['logs'].append(f"HAS RESOURCE {required_resource}")
+    required_resources = SUBMISSION_RESOURCES | {f"/programs/{program}/projects"}
+    missing_resources = required_resources - resources
+    for required_resource in sorted(missing_resources):
+        output['logs'].append(f"{required_resource} not found in user resources")
+        can_create = False
+    for required_resource in sorted(required_resources - missing_resources):
+        output['logs'].append(f"HAS RESOURCE {required_resource}")
 
     required_services = [
         f"/programs/{program}/projects"
     ]
     for required_service in required_services:
-        if required_service not in user['authz']:
+        service_authz = authz.get(required_service)
+        if service_authz is None:
             output['logs'].append(f"{required_service} not found in user authz")
             can_create = False
+        elif SHEEPDOG_AUTHZ not in service_authz:
+            output['logs'].append(f"sheepdog not found in user authz for {required_service}")
+            can_create = False
         else:
-            if {'method': '*', 'service': 'sheepdog'} not in user['authz'][required_service]:
-                output['logs'].append(f"sheepdog not found in user authz for {required_service}")
-                can_create = False
-            else:
-                output['logs'].append(f"HAS SERVICE sheepdog on resource {required_service}")
+            output['logs'].append(f"HAS SERVICE sheepdog on resource {required_service}")
 
     return can_create
 
@@ -107,107 +198,242 @@ def _can_read(output, program, project, user) -> bool:
         user: user dict from arborist (aka profile)
     """
 
+    resources = set(user['resources'])
+    authz = user['authz']
     can_read = True
 
-    if f"/programs/{program}" not in user['resources']:
+    if f"/programs/{program}" not in resources:
         output['logs'].append(f"/programs/{program} not found in user resources")
         can_read = False
 
-    required_resources = [
+    required_resources = {
         f"/programs/{program}/projects/{project}"
-    ]
-    for required_resource in required_resources:
-        if required_resource not in user['resources']:
-            output['logs'].append(f"{required_resource} not found in user resources")
-            can_read = False
-        else:
-            output['logs'].append(f"HAS RESOURCE {required_resource}")
+    }
+    missing_resources = required_resources - resources
+    for required_resource in sorted(missing_resources):
+        output['logs'].append(f"{required_resource} not found in user resources")
+        can_read = False
+    for required_resource in sorted(required_resources - missing_resources):
+        output['logs'].append(f"HAS RESOURCE {required_resource}")
 
     required_services = [
         f"/programs/{program}/projects/{project}"
     ]
     for required_service in required_services:
-        if required_service not in user['authz']:
+        service_authz = authz.get(required_service)
+        if service_authz is None:
             output['logs'].append(f"{required_service} not found in user authz")
             can_read = False
+        elif READ_STORAGE_AUTHZ not in service_authz:
+            output['logs'].append(f"read-storage not found in user authz for {required_service}")
+            can_read = False
         else:
-            if {'method': 'read-storage', 'service': '*'} not in user['authz'][required_service]:
-                output['logs'].append(f"read-storage not found in user authz for {required_service}")
-                can_read = False
-            else:
-                output['logs'].append(f"HAS SERVICE read-storage on resource {required_service}")
+            output['logs'].append(f"HAS SERVICE read-storage on resource {required_service}")
 
     return can_read
 
 
-def _download_and_unzip(object_id, file_path, output) -> bool:
-    """Download and unzip object_id to file_path"""
-    cmd = f"gen3_util files cp {object_id} /tmp/{object_id}".split()
-    result = subprocess.run(cmd)
-    if result.returncode != 0:
-        output['logs'].append(f"ERROR DOWNLOADING {object_id} /tmp/{object_id}")
-        if result.stderr:
-            output['logs'].append(result.stderr.read().decode())
-        if result.stdout:
-            output['logs'].append(result.stdout.read().decode())
-        return False
-    output['logs'].append(f"DOWNLOADED {object_id} {file_path}")
-    cmd = f"unzip -o -j /tmp/{object_id}/*.zip -d {file_path}".split()
-    result = subprocess.run(cmd)
-    if result.returncode != 0:
-        output['logs'].append(f"ERROR UNZIPPING /tmp/{object_id}")
-        if result.stderr:
-            output['logs'].append(result.stderr.read().decode())
-        if result.stdout:
-            output['logs'].append(result.stdout.read().decode())
+def _presigned_url(object_id, auth) -> str:
+    """Get a signed download url for object_id from fence"""
+    # same call as Gen3File.get_presigned_url, but through the shared session so it reuses connections
+    response = _session().get(f"{auth.endpoint}/user/data/download/{object_id}", auth=auth,
+                              timeout=HTTP_TIMEOUT)
+    try:
+        presigned = response.json()
+    except ValueError:
+        presigned = None
+    if not response.ok or not isinstance(presigned, dict) or 'url' not in presigned:
+        # e.g. 403 or an unknown guid, report fence's reason rather than a bare KeyError('url')
+        error = presigned.get('error') if isinstance(presigned, dict) else None
+        raise ValueError(f"fence returned no url for {object_id} (status {response.status_code}): "
+                         f"{error or response.text}")
+    return presigned['url']
+
+
+def _download(object_id, staging_path, output, auth):
+    """Download object_id to an anonymous temp file in staging_path, returns the open file or None"""
+    archive = None
+    try:
+        archive = tempfile.TemporaryFile(dir=staging_path)
+        signed_url = _presigned_url(object_id, auth)
+        with _session().get(signed_url, stream=True, timeout=HTTP_TIMEOUT) as response:
+            response.raise_for_status()
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                archive.write(chunk)
+    except Exception as e:
+        if archive is not None:
+            archive.close()
+        output['logs'].append(f"ERROR DOWNLOADING {object_id}")
+        output['logs'].append(str(e))
+        # the status line alone hides the reason, include what the bucket sent back
+        if isinstance(e, requests.HTTPError) and e.response is not None and e.response.text:
+            output['logs'].append(e.response.text)
+        return None
+    output['logs'].append(f"DOWNLOADED {object_id} {staging_path}")
+    return archive
+
+
+def _unzip(object_id, archive, file_path, output) -> bool:
+    """Extract the downloaded archive of object_id to file_path"""
+    try:
+        archive.seek(0)
+        with zipfile.ZipFile(archive) as zf:
+            _extract_flat(zf, file_path)
+    except Exception as e:
+        output['logs'].append(f"ERROR UNZIPPING {object_id}")
+        output['logs'].append(str(e))
         return False
-
     output['logs'].append(f"UNZIPPED {file_path}")
     return True
 
 
+def _download_and_unzip_all(object_ids, file_path, output, auth) -> bool:
+    """Download and unzip object_ids to file_path, True if all succeeded.
+
+    Downloads run concurrently while the archives are extracted one at a time in
+    object_ids order, so an archive is extracted while the remaining ones are still
+    downloading, and a file name found in several archives is always taken from the last.
+    """
+    # each object_id logs to its own output, merged in order afterwards so logs don't interleave
+    task_outputs = [{'logs': []} for _ in object_ids]
+    results = []
+
+    # stage the archives next to the study rather than in /tmp, which is often a different (tmpfs) mount
+    os.makedirs(file_path, exist_ok=True)
+    with ThreadPoolExecutor(max_workers=min(MAX_DOWNLOAD_WORKERS, len(object_ids))) as executor:
+        downloads = [
+            executor.submit(_download, object_id, file_path, task_output, auth)
+            for object_id, task_output in zip(object_ids, task_outputs)
+        ]
+        # unzip stage, waits for each download in turn
+        for object_id, download, task_output in zip(object_ids, downloads, task_outputs):
+            archive = download.result()
+            if archive is None:
+                results.append(False)
+                continue
+            with archive:
+                results.append(_unzip(object_id, archive, file_path, task_output))
+
+    for task_output in task_outputs:
+        output['logs'].extend(task_output['logs'])
+    return all(results)
+
+
+def _extract_flat(zf, file_path):
+    """Extract all files in zf to file_path, junking their directories (same as `unzip -o -j`)"""
+    # as with `unzip -o -j`, the last member with a given file name wins; keeping only that one
+    # also stops two threads from writing the same target
+    members = {}
+    for member in zf.infolist():
+        if not member.is_dir():
+            members[os.path.basename(member.filename)] = member
+    members = list(members.values())
+    if not members:
+        return
+    # archives hold many small ndjson files, overlap their decompression and writes
+    with ThreadPoolExecutor(max_workers=min(MAX_EXTRACT_WORKERS, len(members))) as executor:
+        list(executor.map(lambda member: _extract_member(zf, member, file_path), members))
+
+
+def _extract_member(zf, member, file_path):
+    """Extract a single zip member to file_path, without its directory"""
+    target = os.path.join(file_path, os.path.basename(member.filename))
+    with zf.open(member) as src, open(target, 'wb') as dst:
+        shutil.copyfileobj(src, dst)
+
+
 def _load_all(study, project_id, output) -> bool:
     """Use script to load study."""
     cmd = f"./load_all".split()
     output['logs'].append(f"LOADING: {cmd}")
-    my_env = os.environ.copy()
-    my_env['study'] = study
-    my_env['project_id'] = project_id
-    my_env['schema'] = 'https://aced-public.s3.us-west-2.amazonaws.com/aced-test.json'
-
-    result = subprocess.run(cmd, env=my_env, capture_output=True, text=True)
-    if result.returncode != 0:
+    my_env = {**_base_env(), 'study': study, 'project_id': project_id, 'schema': SCHEMA_URL}
+
+    # stream the script's combined stdout/stderr into the logs line by line as it runs
+    # replace undecodable bytes, a decode error would stop the drain and leave the script writing to a dead pipe
+    process = subprocess.Popen(cmd, env=my_env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                               bufsize=1, text=True, encoding='utf-8', errors='replace')
+    drain = threading.Thread(target=_drain, args=(process.stdout, output), daemon=True)
+    drain.start()
+    returncode = process.wait()
+    drain.join()
+    process.stdout.close()
+
+    if returncode != 0:
         output['logs'].append(f"ERROR LOADING {study}")
-        output['logs'].append(result.stderr)
-        output['logs'].append(result.stdout)
         return False
 
     output['logs'].append(f"LOADED {study}")
-    output['logs'].append(result.stderr)
-    output['logs'].append(result.stdout)
     return True
 
 
-def _get(input_data, output, program, project, user) -> str:
-    """Export data from the fhir store to bucket, returns object_id."""
+def _drain(stream, output):
+    """Append each line of stream to the logs, until the writer closes it"""
+    for line in stream:
+        output['logs'].append(line.rstrip())
+
+
+def _get(input_data, output, program, project, user, uploader, uploads):
+    """Export data from the fhir store, then queue its upload to bucket on uploader.
+
+    The upload sets output['object_id'] once done, so in a batch it overlaps the
+    export of the next work item. uploads maps each (resolved) study path to its latest upload.
+    """
+    # only needed for export, imported here so `put` jobs don't pay for them at startup
+    from aced_submission.fhir_store import fhir_get
+    from aced_submission.meta_flat_load import DEFAULT_ELASTIC
+
     can_read = _can_read(output, program, project, user)
     if not can_read:
         output['logs'].append(f"No read permissions on {program}-{project}")
-        return None
+        return
 
     study_path = f"studies/{project}"
     project_id = f"{program}-{project}"
 
+    _wait_for_upload(study_path, uploads)
+
+    # start from an empty study directory, it may hold files of an earlier work item
+    _clear_study('studies', project)
+
     logs = fhir_get(f"{program}-{project}", study_path, DEFAULT_ELASTIC)
     output['logs'].extend(logs)
 
-    # zip and upload the exported files to bucket
-    config = Config()
-    cp_result = cp(config=config, from_=study_path, project_id=project_id, ignore_state=False)
-    output['logs'].append(cp_result['msg'])
-    object_id = cp_result['object_id']
+    uploads[os.path.realpath(study_path)] = uploader.submit(_upload, study_path, project_id, output)
+
+
+def _wait_for_upload(study_path, uploads):
+    """Wait for a pending upload of study_path, so its files aren't replaced while being zipped."""
+    upload = uploads.get(os.path.realpath(study_path))
+    if upload is not None:
+        wait([upload])
+
+
+def _clear_study(studies_path, project):
+    """Delete the study directory of project under studies_path, if there is one."""
+    study_path = os.path.realpath(os.path.join(studies_path, project))
+    # project comes from the caller's project_id, never delete anything but a direct child of studies_path
+    assert os.path.dirname(study_path) == os.path.realpath(studies_path), \
+        f"refusing to delete {study_path}, not a study directory"
+    if os.path.isdir(study_path):
+        shutil.rmtree(study_path)
 
-    return object_id
+
+def _upload(study_path, project_id, output):
+    """Zip and upload the exported files to bucket, sets output['object_id'].
+
+    Runs on the uploader, a failure is recorded in output (`error`) like in `_run`.
+    """
+    from gen3_util.config import Config
+    from gen3_util.meta.uploader import cp
+
+    try:
+        config = Config()
+        cp_result = cp(config=config, from_=study_path, project_id=project_id, ignore_state=False)
+        output['logs'].append(cp_result['msg'])
+        output['object_id'] = cp_result['object_id']
+    except Exception as e:
+        output['logs'].append(f"ERROR UPLOADING {study_path} {type(e).__name__}: {e}")
+        output['error'] = str(e)
 
 
 def _main():
@@ -221,44 +447,84 @@ def _main():
     # print("[out] retrieving user info...")
     user = _user(auth)
 
-    output = {'user': user, 'files': [], 'logs': []}
+    input_data = _input_data()
+
+    # a single upload worker, uploads run one at a time in the background of the next work item
+    uploads = {}
+    with ThreadPoolExecutor(max_workers=1) as uploader:
+        if isinstance(input_data, list):
+            # batch, process every work item in this process reusing auth and user
+            outputs = [_run(work_item, auth, user, uploader, uploads) for work_item in input_data]
+        else:
+            outputs = [_run(input_data, auth, user, uploader, uploads)]
+    # note, only the last output (a line in stdout with `[out]` prefix) is returned to the caller
+    if isinstance(input_data, list):
+        print(f"[out] [{','.join(_dumps(output) for output in outputs)}]")
+    else:
+        print(f"[out] {_dumps(outputs[0])}")
+
+    # the outputs are printed either way, still fail the job if a work item raised
+    if any('error' in output for output in outputs):
+        sys.exit(1)
+
+
+def _run(input_data, auth, user, uploader, uploads) -> dict:
+    """Process a single work item, returns its output (get outputs are complete once uploader is done).
+
+    An exception is recorded in the item's output (`error`) rather than raised, so the
+    outputs of the other work items, which may already be loaded, are still returned.
+    """
+
+    output = {'user': user, 'files': [], 'logs': _Logs()}
 
     # output['env'] = {k: v for k, v in os.environ.items()}
 
-    input_data = _input_data()
+    try:
+        _run_method(input_data, output, auth, user, uploader, uploads)
+    except Exception as e:
+        output['logs'].append(f"ERROR {type(e).__name__}: {e}")
+        output['error'] = str(e)
+
+    return output
+
+
+def _run_method(input_data, output, auth, user, uploader, uploads):
+    """Dispatch a work item to _put or _get according to its method."""
+
     program, project = _get_program_project(input_data)
 
     method = input_data.get("method", None)
     assert method, "input data must contain a `method`"
     if method.lower() == 'put':
         # read from bucket, write to fhir store
-        _put(input_data, output, program, project, user)
+        _put(input_data, output, program, project, user, auth, uploads)
     elif method.lower() == 'get':
         # read fhir store, write to bucket
-        object_id = _get(input_data, output, program, project, user)
-        output['object_id'] = object_id
+        output['object_id'] = None
+        _get(input_data, output, program, project, user, uploader, uploads)
     else:
         raise Exception(f"unknown method {method}")
 
-    # note, only the last output (a line in stdout with `[out]` prefix) is returned to the caller
-    print(f"[out] {json.dumps(output, separators=(',', ':'))}")
-
 
-def _put(input_data, output, program, project, user):
+def _put(input_data, output, program, project, user, auth, uploads):
     """Import data from bucket to graph, flat and fhir store."""
     # check permissions
     can_create = _can_create(output, program, user)
     output['logs'].append(f"CAN CREATE: {can_create}")
     file_path = f"/root/studies/{project}/"
     if can_create:
-        object_id = _get_object_id(input_data)
-        if object_id:
-            # get the meta data file
-            if _download_and_unzip(object_id, file_path, output):
+        object_ids = _get_object_ids(input_data)
+        if object_ids:
+            # start from an empty study directory, it may hold files of an earlier work item
+            # (including an export that is still being uploaded)
+            _wait_for_upload(file_path, uploads)
+            _clear_study('/root/studies', project)
+            # get the meta data files, all archives are extracted into the same study directory
+            if _download_and_unzip_all(object_ids, file_path, output, auth):
 
                 # tell user what files were found
-                for _ in pathlib.Path(file_path).glob('*'):
-                    output['files'].append(str(_))
+                with os.scandir(file_path) as entries:
+                    output['files'].extend(entry.path for entry in entries)
 
                 # load the study into the database and elastic search
                 _load_all(project, f"{program}-{project}", output)